@@ -1,17 +1,88 @@
 """
 Entry Point
 """
+import json
 import asyncio
+import argparse
 
-from dotplug.main import main
+from dotplug.main import main, manifest, MANIFEST
 from dotplug.console import ncurses
+from dotplug import serve, outdated, daemon, trace
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(prog='dot')
+    parser.add_argument(
+        '--manifest', metavar='PATH', help='manifest to install from')
+    parser.add_argument(
+        '--headless', action='store_true',
+        help='install without drawing anything on screen')
+    parser.add_argument(
+        '--profile', metavar='PATH',
+        help='trace the run and write a chrome trace to path')
+    parser.add_argument(
+        '--lag', type=float, metavar='SECONDS',
+        help='sample event loop lag at this interval while profiling')
+    commands = parser.add_subparsers(dest='command')
+
+    cache = commands.add_parser(
+        'serve', help='serve the local archive cache to peers')
+    cache.add_argument('--host', default=serve.DEFAULT_HOST)
+    cache.add_argument('--port', type=int, default=serve.DEFAULT_PORT)
+
+    check = commands.add_parser(
+        'outdated', help='list manifest entries with newer versions')
+    check.add_argument('--ttl', type=int, default=outdated.DEFAULT_TTL)
+    check.add_argument('--jobs', type=int, default=outdated.MAX_CONCURRENCY)
+
+    watch = commands.add_parser(
+        'daemon', help='keep running and apply manifest changes')
+    watch.add_argument('manifests', nargs='*', default=[MANIFEST])
+    watch.add_argument('--socket', default=daemon.SOCKET)
+
+    ctl = commands.add_parser('ctl', help='talk to a running daemon')
+    ctl.add_argument('request', choices=['status', 'apply', 'stop'])
+    ctl.add_argument('--force', action='store_true')
+    ctl.add_argument('--socket', default=daemon.SOCKET)
+
+    return parser.parse_args(args)
 
 
 def _main():
+    args = parse_args()
+
+    if args.command == 'ctl':
+        kw = {'force': True} if args.force else {}
+        response = daemon.request(args.request, args.socket, **kw)
+        print(json.dumps(response, indent=2))
+        return
 
     import uvloop
     asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    with ncurses():
-        asyncio.run(main())
-        input("")
+    if args.command == 'serve':
+        serve.serve(args.host, args.port)
+        return
+
+    if args.command == 'outdated':
+        rows = asyncio.run(
+            outdated.outdated(manifest(args.manifest), args.ttl, args.jobs))
+        outdated.report(rows)
+        return
+
+    if args.command == 'daemon':
+        asyncio.run(daemon.Daemon(args.manifests, args.socket).run())
+        return
+
+    tracer = trace.enable() if args.profile else None
+
+    if args.headless:
+        asyncio.run(trace.profile(main(args.manifest, True), args.lag))
+    else:
+        with ncurses():
+            asyncio.run(trace.profile(main(args.manifest), args.lag))
+            input("")
+
+    if tracer is not None:
+        trace.write_chrome(tracer, args.profile)
+        print(trace.summary(tracer))
@@ -2,11 +2,17 @@
 This module contains functionality relating to archives
 """
 import os
+import json
+import time
+import shutil
+import asyncio
 import tarfile
 import zipfile
 
 import aiohttp
-import aiofiles
+
+from dotplug import trace
+from dotplug.mirrors import MirrorStats, transfer
 
 
 class ZipFile(zipfile.ZipFile):
@@ -32,31 +38,43 @@ def unzip(archive, dest):
     """
     Unpacks the zipfile to provided dest location
     """
+    packed = load_packed(archive)
+    if packed is not None:
+        return unpack(archive, dest, packed)
+
     relpath = os.path.relpath
 
-    with ZipFile(archive) as z:
+    with ZipFile(archive) as z, trace.span('archive.unzip') as span:
         prefix = os.path.commonprefix(z.namelist())
+        size = 0
         for m in z.filelist:
             if m.is_dir() or m.filename in ('.', '/'):
                 continue
             m.filename = relpath(m.filename, prefix)
             z.extract(m, path=dest)
+            size += m.file_size
+        span.set(archive=archive, bytes=size)
 
 
 def untar(archive, dest):
     """
     Unpacks the tarfile to provided dest location
     """
+    packed = load_packed(archive)
+    if packed is not None:
+        return unpack(archive, dest, packed)
+
     relpath = os.path.relpath
 
     try:
-        with tarfile.open(archive) as tar:
+        with tarfile.open(archive) as tar, trace.span('archive.untar') as span:
             members = [m for m in tar if m.isreg()]
 
             prefix = os.path.commonprefix([m.name for m in members])
             for m in members:
                 m.name = relpath(m.name, prefix)
             tar.extractall(dest, members=members)
+            span.set(archive=archive, bytes=sum(m.size for m in members))
     except tarfile.ReadError as e:
         raise tarfile.ReadError('{} is bad archive'.format(archive))
 
@@ -65,7 +83,8 @@ def validate_zip(archive):
     """
     Ensure we are working with a non corrupt zipfile
     """
-    with ZipFile(archive) as z:
+    with ZipFile(archive) as z, trace.span(
+            'archive.validate', archive=archive):
         if z.testzip() is not None:
             return False
     return True
@@ -76,12 +95,16 @@ def validate_tar(archive):
     Ensure we are working with a non corrupt tarfile
     """
     try:
-        with tarfile.open(archive) as tar:
+        with tarfile.open(archive) as tar, trace.span(
+                'archive.validate', archive=archive) as span:
+            size = 0
             for m in tar:
                 if m.isreg():
                     check = tar.extractfile(m.name)
                     for chunk in iter(lambda: check.read(1024), b''):
                         pass
+                    size += m.size
+            span.set(bytes=size)
     except (EOFError):
         res = False
     else:
@@ -89,48 +112,399 @@ def validate_tar(archive):
     return res
 
 
-async def download(session, task):
+# Repacking keeps an uncompressed copy of each archive next to it, members are
+# stored back to back with the common prefix already stripped and an index of
+# where each member lives. Every member is read in full while repacking, so a
+# packed copy only exists for archives that decompress cleanly. Enabled by
+# setting _BASE_REPACK.
+REPACK = os.environ.get('_BASE_REPACK', '') not in ('', '0')
+PACKED_VERSION = 1
+COPY_CHUNK = 1024 * 1024
+
+_REPACKS = {}
+
+
+def load_packed(archive):
+    """
+    Return the index of the packed copy of archive
+
+    None is returned if there is no packed copy or if it is out of date with
+    the archive.
+    """
+    try:
+        with open(f'{archive}.packed.json') as f:
+            packed = json.load(f)
+        source = os.stat(archive)
+        blob = os.stat(f'{archive}.packed')
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if packed.get('version') != PACKED_VERSION:
+        return None
+    if packed.get('source') != [source.st_mtime_ns, source.st_size]:
+        return None
+    if packed.get('size') != blob.st_size:
+        return None
+    return packed
+
+
+def _repack(archive, tmp):
+    """
+    Copy all members of archive into tmp, returning their raw names, the
+    member index and the total size
+    """
+    names, members = [], []
+    with open(tmp, 'wb') as out, trace.span(
+            'archive.repack', archive=archive) as span:
+        if zipfile.is_zipfile(archive):
+            with ZipFile(archive) as z:
+                names = z.namelist()
+                for m in z.filelist:
+                    if m.is_dir() or m.filename in ('.', '/'):
+                        continue
+                    offset = out.tell()
+                    with z.open(m) as src:
+                        shutil.copyfileobj(src, out, COPY_CHUNK)
+                    members.append([m.filename, offset, m.file_size, 0o755])
+        else:
+            with tarfile.open(archive) as tar:
+                for m in tar:
+                    if not m.isreg():
+                        continue
+                    offset = out.tell()
+                    shutil.copyfileobj(tar.extractfile(m), out, COPY_CHUNK)
+                    members.append([m.name, offset, m.size, m.mode])
+                names = [m[0] for m in members]
+        size = out.tell()
+        span.set(bytes=size)
+    return names, members, size
+
+
+def repack(archive):
+    """
+    Write the packed copy of archive along with its index
+
+    The archive is only read once, names are stripped from their common
+    prefix after the fact the same way `untar` and `unzip` do it.
+    """
+    stat = os.stat(archive)
+    blob = f'{archive}.packed'
+    tmp = f'{blob}.tmp'
+
+    try:
+        names, members, size = _repack(archive, tmp)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    prefix = os.path.commonprefix(names)
+    for m in members:
+        m[0] = os.path.relpath(m[0], prefix)
+
+    os.replace(tmp, blob)
+    with open(f'{blob}.json.tmp', 'w') as f:
+        json.dump({
+            'version': PACKED_VERSION,
+            'source': [stat.st_mtime_ns, stat.st_size],
+            'size': size,
+            'members': members,
+        }, f)
+    os.replace(f'{blob}.json.tmp', f'{blob}.json')
+
+
+def _copy_range(src, dst, offset, size):
+    """
+    Copy size bytes from offset in src to the current position of dst,
+    inside the kernel where possible
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    while size:
+        if copy_file_range is not None:
+            try:
+                copied = copy_file_range(src, dst, size, offset)
+            except OSError:
+                copy_file_range = None
+                continue
+        else:
+            data = os.pread(src, min(size, COPY_CHUNK), offset)
+            copied = os.write(dst, data) if data else 0
+
+        if not copied:
+            raise EOFError('packed archive is truncated')
+        offset += copied
+        size -= copied
+
+
+def unpack(archive, dest, packed):
+    """
+    Unpacks the packed copy of archive to provided dest location
+    """
+    made = set()
+    with open(f'{archive}.packed', 'rb') as src, trace.span(
+            'archive.unpack', archive=archive, bytes=packed['size']):
+        for name, offset, size, mode in packed['members']:
+            path = os.path.join(dest, name)
+            dirname = os.path.dirname(path)
+            if dirname not in made:
+                os.makedirs(dirname, exist_ok=True)
+                made.add(dirname)
+
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+            try:
+                _copy_range(src.fileno(), fd, offset, size)
+                os.fchmod(fd, mode)
+            finally:
+                os.close(fd)
+
+
+def schedule_repack(archive):
+    """
+    Repack archive in the background, once
+    """
+    if archive in _REPACKS:
+        return
+
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(None, repack, archive)
+    _REPACKS[archive] = future
+    future.add_done_callback(lambda f: _REPACKS.pop(archive, None))
+
+
+async def wait_for_repacks():
+    """
+    Wait for all background repacks to finish, failures are ignored as the
+    original archive is still there
+    """
+    if _REPACKS:
+        await asyncio.gather(*_REPACKS.values(), return_exceptions=True)
+
+
+# Writes are collected in a buffer of this size before they hit the disk, each
+# flush is a single trip to the executor.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Progress is only redrawn this often, in seconds
+PROGRESS_INTERVAL = 0.1
+
+
+class ArchiveWriter:
+    """
+    Buffered writer for downloads
+
+    Chunks are coalesced in a reusable buffer and written to disk with a
+    single executor call per flush. The file can be preallocated once the
+    size is known and is only synced to disk on close.
+    """
+
+    def __init__(self, path, buffer_size=WRITE_BUFFER_SIZE):
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._used = 0
+        self._position = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _write_all(self, data):
+        while data:
+            written = os.write(self._fd, data)
+            data = data[written:]
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def preallocate(self, size):
+        """
+        Reserve size bytes on disk, best effort as not all filesystems can
+        """
+        if not size or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(self._fd, 0, size)
+        except OSError:
+            pass
+
+    async def write(self, chunk):
+        size = len(chunk)
+        if self._used + size > len(self._buffer):
+            await self.flush()
+
+        if size >= len(self._buffer):
+            await self._run(self._write_all, memoryview(chunk))
+        else:
+            self._view[self._used:self._used + size] = chunk
+            self._used += size
+        self._position += size
+
+    async def flush(self):
+        if not self._used:
+            return
+        await self._run(self._write_all, self._view[:self._used])
+        self._used = 0
+
+    async def reset(self):
+        """
+        Throw away everything written so far and start from the beginning
+        """
+        self._used = 0
+        self._position = 0
+        await self._run(os.ftruncate, self._fd, 0)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+
+    async def close(self):
+        if self._fd is None:
+            return
+
+        def finish():
+            # Drop whatever was preallocated but never written
+            os.ftruncate(self._fd, self._position)
+            os.fsync(self._fd)
+            os.close(self._fd)
+
+        try:
+            await self.flush()
+        finally:
+            await self._run(finish)
+            self._fd = None
+
+
+# Peer caches are other machines running `dot serve`, they are tried in order
+# before falling back on the upstream repo url.
+ARCHIVE_PEERS = os.environ.get('_BASE_PEERS', '').replace(',', ' ').split()
+
+
+class DigestError(Exception):
+    """
+    Raised when a downloaded archive does not match the expected digest
+    """
+
+
+def peer_urls(task):
+    """
+    Yield archive urls for each of the configured peer caches
+    """
+    filename = os.path.basename(task.archive)
+    for peer in ARCHIVE_PEERS:
+        yield f'{peer.rstrip("/")}/{task.name}/{filename}'
+
+
+async def fetch(session, urls, path, bar, stats, resume=False):
+    """
+    Stream the content of the best of given mirror urls to path
+
+    Set resume if the result is verified against a known digest, see
+    `dotplug.mirrors.transfer`. Returns the sha256 hexdigest of the content
+    together with the response etag, stripped from quotes.
+    """
+    last = 0
+
+    def progress(total, size):
+        nonlocal last
+        now = time.monotonic()
+        if now - last > PROGRESS_INTERVAL or total == size:
+            bar.message.write(f'{total}/{size} ... Downloading')
+            last = now
+
+    async with ArchiveWriter(path) as f:
+        result = await transfer(session, urls, f, stats, progress, resume)
+    bar.message.clear()
+    return result
+
+
+async def download(session, task, stats=None):
     """
     Download repo given from the task url
+
+    Peer caches are tried first when the task has an expected digest, a peer
+    result is only accepted if it matches. Without a digest there is nothing
+    trustworthy to check a peer against so they are skipped. After that the
+    upstream mirrors of the task are raced, see `dotplug.mirrors`. Archives
+    are written to a partial file and moved in place once verified.
     """
     archive, bar = task.archive, task.bar
-    async with session.get(task.url) as response:
-        size = int(response.headers.get('content-length', 0))
+    stats = stats or MirrorStats()
+
+    # Download archive if does not exist
+    dirname = os.path.dirname(archive)
+    if not os.path.exists(dirname):
+        os.makedirs(os.path.dirname(archive))
 
-        # Download archive if does not exist
-        dirname = os.path.dirname(archive)
-        if not os.path.exists(dirname):
-            os.makedirs(os.path.dirname(archive))
+    partial = f'{archive}.part'
+    peers = peer_urls(task) if task.sha256 is not None else ()
+    for url in peers:
+        try:
+            with trace.span('archive.peer', app=task.name, url=url):
+                digest, _ = await fetch(session, [url], partial, bar, stats)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            continue
 
-        async with aiofiles.open(archive, mode='wb') as f:
-            total = 0
-            async for chunk in response.content.iter_chunked(1024):
-                await f.write(chunk)
-                total += len(chunk)
+        if digest == task.sha256:
+            os.replace(partial, archive)
+            return
 
-                bar.message.write(f'{total}/{size} ... Downloading')
-            bar.message.clear()
+    with trace.span('archive.download', app=task.name):
+        digest, _ = await fetch(
+            session, task.urls, partial, bar, stats, task.sha256 is not None)
+    if task.sha256 is not None and digest != task.sha256:
+        os.remove(partial)
+        raise DigestError(f'{task.name} does not match expected digest')
+    os.replace(partial, archive)
 
 
-async def ensure_archive(task):
+async def ensure_archive(task, stats=None, session=None, index=None):
     """
     Ensure that the taks archive exists and we have something to act upon.
+
+    A shared session can be given to reuse connections between tasks. index
+    is an optional mapping of archive path to (mtime, size) of archives that
+    have already been validated, they are trusted for as long as they are
+    unchanged on disk.
     """
     archive, bar = task.archive, task.bar
 
+    try:
+        stat = os.stat(archive)
+    except FileNotFoundError:
+        stat = None
+
     # Download archive if it doesn't exist
-    if os.path.exists(archive):
-        if not task.type == 'appimage':
-            bar.message.write('Validating Archive ... ')
-            validator = {
-                'tar': validate_tar,
-                'zip': validate_zip,
-            }[task.type]
-            valid = await bar.loader.wait_for(validator, archive)
+    if stat is None:
+        valid = False
+    elif index is not None and index.get(archive) == (
+            stat.st_mtime_ns, stat.st_size):
         valid = True
+    elif load_packed(archive) is not None:
+        # Repacking reads and decompresses every member, a successful repack
+        # checks the archive at least as well as validating it would
+        valid = True
+    elif not task.type == 'appimage':
+        bar.message.write('Validating Archive ... ')
+        validator = {
+            'tar': validate_tar,
+            'zip': validate_zip,
+        }[task.type]
+        valid = await bar.loader.wait_for(validator, archive)
     else:
-        valid = False
+        valid = True
 
     if not valid:
-        async with aiohttp.ClientSession() as session:
-            await download(session, task)
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                await download(session, task, stats)
+        else:
+            await download(session, task, stats)
+
+    if index is not None:
+        stat = os.stat(archive)
+        index[archive] = (stat.st_mtime_ns, stat.st_size)
+
+    # Fresh downloads are repacked without validating them first, a corrupt
+    # archive makes the repack fail and no packed copy is written
+    if REPACK and task.type in ('tar', 'zip') and load_packed(archive) is None:
+        schedule_repack(archive)
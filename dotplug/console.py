@@ -238,6 +238,9 @@ class TaskBar:
 
     """
 
+    # Seconds a message stays on screen before the next step replaces it
+    PAUSE = 2
+
     def __init__(self, name, x, y, initial_message=''):
 
         # Setup Task Modules
@@ -278,6 +281,9 @@ class TaskBar:
     def set_state(self, state: TaskStatus):
         self._status.status = state
 
+    async def pause(self):
+        await asyncio.sleep(self.PAUSE)
+
     @property
     def height(self):
         return self._y
@@ -301,3 +307,70 @@ class TaskBar:
     @property
     def message(self):
         return self._message
+
+
+class HeadlessMessage:
+    """
+    Message bar that only remembers the last message written
+    """
+
+    def __init__(self):
+        self.text = ''
+
+    def write(self, msg, x=0, color=ColorPair.WHITE):
+        self.text = msg
+
+    def clear(self):
+        self.text = ''
+
+
+class HeadlessLoader:
+    """
+    Loader bar that waits without drawing anything
+    """
+
+    async def wait_for(self, coro, *args):
+        if inspect.iscoroutinefunction(coro):
+            coro = coro()
+
+        if asyncio.iscoroutine(coro):
+            return await coro
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, coro, *args)
+
+
+class HeadlessStatus:
+    def __init__(self):
+        self.status = TaskStatus.IDLE
+
+
+class HeadlessBar:
+    """
+    Drop in replacement for TaskBar when there is no screen to draw on
+
+    Keeps track of the state and last message of the task so it can be
+    queried, and never pauses between steps.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.message = HeadlessMessage()
+        self.loader = HeadlessLoader()
+        self.status = HeadlessStatus()
+
+    def waiting(self):
+        self.status.status = TaskStatus.IDLE
+
+    def running(self):
+        self.status.status = TaskStatus.RUNNING
+
+    def done(self, msg=''):
+        if self.status.status != TaskStatus.SUCCESSFUL:
+            self.status.status = TaskStatus.FAILED
+
+    def set_state(self, state: TaskStatus):
+        self.status.status = state
+
+    async def pause(self):
+        pass
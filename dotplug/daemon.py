@@ -0,0 +1,360 @@
+"""
+This module contains the dotplug daemon
+
+The daemon keeps the parsed manifest, the state of each task, a warm http
+session and an index of validated archives in memory. Manifest files are
+watched and only the entries that changed since the last run are applied.
+
+A thin client talks to the daemon over a unix socket, one json request and
+one json response per line:
+
+    {"command": "status"}
+    {"command": "apply", "force": false}
+    {"command": "stop"}
+"""
+import os
+import json
+import socket
+import struct
+import asyncio
+import tempfile
+import ctypes
+import ctypes.util
+
+import aiohttp
+
+from dotplug import links
+from dotplug.main import consumer, manifest, MAX_QUEUE_SIZE
+from dotplug.tasks import mktask, ARCHIVE_DIRECTORY, INSTALL_LOCATION
+from dotplug.archive import wait_for_repacks
+from dotplug.mirrors import MirrorStats
+from dotplug.console import HeadlessBar, TaskStatus
+
+SOCKET = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()),
+    f'dotplug-{os.getuid()}.sock',
+)
+
+# Editors tend to write files in several steps, wait for things to settle
+DEBOUNCE = 0.2
+POLL_INTERVAL = 1.0
+
+# inotify, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+_EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    """
+    Call back whenever one of the given files changes
+
+    Uses inotify on the parent directories so files replaced by editors are
+    picked up, and falls back on polling where inotify is not available.
+    """
+
+    def __init__(self, paths, callback):
+        self._paths = {os.path.abspath(p) for p in paths}
+        self._callback = callback
+        self._loop = asyncio.get_event_loop()
+        self._handle = None
+        self._fd = None
+        self._poll = None
+
+    def start(self):
+        try:
+            self._start_inotify()
+        except (OSError, AttributeError):
+            self._poll = asyncio.ensure_future(self._polling())
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+        if self._poll is not None:
+            self._poll.cancel()
+
+    def _changed(self):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._loop.call_later(DEBOUNCE, self._callback)
+
+    def _start_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for directory in {os.path.dirname(p) for p in self._paths}:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+            if wd < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+        self._fd = fd
+        self._loop.add_reader(fd, self._read)
+
+    def _read(self):
+        try:
+            buf = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+
+        names = set()
+        offset = 0
+        while offset < len(buf):
+            _, _, _, size = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            names.add(os.fsdecode(buf[offset:offset + size].rstrip(b'\0')))
+            offset += size
+
+        if names & {os.path.basename(p) for p in self._paths}:
+            self._changed()
+
+    def _mtimes(self):
+        mtimes = {}
+        for path in self._paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtimes[path] = None
+        return mtimes
+
+    async def _polling(self):
+        previous = self._mtimes()
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            current = self._mtimes()
+            if current != previous:
+                previous = current
+                self._changed()
+
+
+class Daemon:
+    """
+    Keeps dotplug state around between runs and applies manifest changes
+    """
+
+    def __init__(self, paths, socket_path=SOCKET):
+        # Builds change the working directory of the whole process
+        self.paths = [os.path.abspath(p) for p in paths]
+        self.socket_path = socket_path
+
+        self.entries = {}
+        self.tasks = {}
+        self.errors = {}
+        self.index = {}
+        self.stats = MirrorStats(
+            os.path.join(ARCHIVE_DIRECTORY, '.mirrors.json'))
+        self.farm = links.LinkFarm(
+            os.path.join(INSTALL_LOCATION, links.STATE),
+            os.pathsep.join(self.paths),
+        )
+
+        self.session = None
+        self._lock = asyncio.Lock()
+        self._stopped = asyncio.Event()
+
+    def load(self):
+        """
+        Return the entries of all manifest files keyed on name
+        """
+        entries = {}
+        for path in self.paths:
+            for entry in manifest(path):
+                entries[entry['name']] = entry
+        return entries
+
+    def status(self):
+        status = {}
+        for name, task in self.tasks.items():
+            status[name] = {
+                'version': task.version,
+                'status': TaskStatus(task.bar.status.status).name,
+                'message': task.bar.message.text,
+            }
+        for name, error in self.errors.items():
+            status[name] = {'status': TaskStatus.FAILED.name, 'message': error}
+        return status
+
+    async def apply(self, force=False):
+        """
+        Apply the manifest entries that changed since the last run
+
+        Entries that failed last time are retried. Returns a summary of what
+        was done.
+        """
+        async with self._lock:
+            try:
+                entries = self.load()
+            except (OSError, ValueError) as e:
+                return {'error': str(e)}
+
+            tasks, changed, errors = {}, [], {}
+            for name, entry in entries.items():
+                previous = self.tasks.get(name)
+                unchanged = (
+                    previous is not None
+                    and self.entries.get(name) == entry
+                    and previous.bar.status.status != TaskStatus.FAILED
+                )
+                if unchanged and not force:
+                    tasks[name] = previous
+                    continue
+
+                try:
+                    task = mktask(entry)
+                except (KeyError, TypeError) as e:
+                    errors[name] = f'Bad Entry: {e}'
+                    continue
+
+                task.bar = HeadlessBar(name)
+                # Same version with a new recipe has to be built again
+                old = self.entries.get(name)
+                if force or old is not None and old['version'] == task.version:
+                    task.force = True
+                tasks[name] = task
+                changed.append(name)
+
+            seen = {
+                name: task.bar.status.status
+                for name, task in tasks.items() if name not in changed
+            }
+            # Dependencies we can't install would otherwise be waited on
+            # forever
+            for task in tasks.values():
+                for name in task.depend - set(tasks):
+                    seen[name] = TaskStatus.FAILED
+
+            q = asyncio.Queue()
+            for name in changed:
+                q.put_nowait(tasks[name])
+
+            # Unchanged tasks are linked already and keep their links
+            self.farm.retain(set(tasks) - set(changed))
+            await asyncio.gather(*(
+                consumer(
+                    q, seen, self.stats, self.session, self.index, self.farm)
+                for _ in range(MAX_QUEUE_SIZE)
+            ))
+
+            removed = [name for name in self.entries if name not in entries]
+            self.entries = {n: e for n, e in entries.items() if n in tasks}
+            self.tasks = tasks
+            self.errors = errors
+
+            loop = asyncio.get_event_loop()
+            ops = await loop.run_in_executor(
+                None, self.farm.prune, list(tasks.values()))
+            self.farm.save()
+            self.stats.save()
+
+            return {
+                'changed': changed,
+                'removed': removed,
+                # Missing dependencies are in seen too, they are no packages
+                'failed': sorted(set(errors) | {
+                    n for n, s in seen.items()
+                    if s == TaskStatus.FAILED and n in tasks
+                }),
+                'pruned': len(ops),
+            }
+
+    async def handle(self, reader, writer):
+        try:
+            request = json.loads(await reader.readline())
+            command = request.get('command')
+            if command == 'status':
+                response = self.status()
+            elif command == 'apply':
+                response = await self.apply(request.get('force', False))
+            elif command == 'stop':
+                response = {'stopping': True}
+                self._stopped.set()
+            else:
+                response = {'error': f'unknown command {command}'}
+        except Exception as e:
+            # Always answer, the client is waiting for a line
+            response = {'error': f'{type(e).__name__}: {e}'}
+
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+        writer.close()
+
+    def _claim_socket(self):
+        """
+        Remove a stale socket, refusing if another daemon is listening on it
+        """
+        if not os.path.exists(self.socket_path):
+            return
+
+        with socket.socket(socket.AF_UNIX) as sock:
+            try:
+                sock.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError(
+                    f'daemon already running on {self.socket_path}')
+
+    async def _apply(self):
+        """
+        Apply and print the outcome, failures included
+        """
+        try:
+            response = await self.apply()
+        except Exception as e:
+            response = {'error': f'{type(e).__name__}: {e}'}
+        print(json.dumps(response), flush=True)
+
+    def _changed(self):
+        asyncio.ensure_future(self._apply())
+
+    async def run(self):
+        self._claim_socket()
+        self.session = aiohttp.ClientSession()
+        watcher = Watcher(self.paths, self._changed)
+        server = None
+        try:
+            server = await asyncio.start_unix_server(
+                self.handle, path=self.socket_path)
+            # Watch first so edits made during the first, slowest, apply are
+            # picked up, applies are serialized on the lock anyway
+            watcher.start()
+            await self._apply()
+            await self._stopped.wait()
+        finally:
+            watcher.stop()
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+                os.remove(self.socket_path)
+            await self.session.close()
+            await wait_for_repacks()
+
+
+def request(command, socket_path=SOCKET, **kw):
+    """
+    Send a single command to the daemon and return its response
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise RuntimeError(f'no daemon running on {socket_path}')
+
+        sock.sendall(json.dumps(dict(kw, command=command)).encode() + b'\n')
+        response = b''
+        while not response.endswith(b'\n'):
+            chunk = sock.recv(64 * 1024)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response)
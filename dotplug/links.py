@@ -0,0 +1,260 @@
+"""
+This module contains the link farm manager
+
+Instead of removing and recreating every link on each run we build the set of
+links we want, compare it against what is already on disk and only touch the
+links that differ.
+
+Every link we put in place is recorded in a state file together with its
+target and the scope it was made for, usually the manifest. Only recorded
+links of the same scope are ever pruned, links of other manifests and links
+made by hand are left alone.
+"""
+import os
+import json
+import threading
+from collections import namedtuple
+
+Link = namedtuple('Link', ['path', 'target', 'owner'])
+Conflict = namedtuple('Conflict', ['path', 'owners'])
+
+CREATE = 'create'
+REPLACE = 'replace'
+REMOVE = 'remove'
+
+STATE = '.links.json'
+
+
+def candidates(tasks):
+    """
+    Yield every link wanted by the tasks, whether the target exists or not
+    """
+    for task in tasks:
+        if task.link is None:
+            continue
+
+        for path, target in task.links():
+            yield Link(path, target, task.name)
+
+
+def desired(tasks):
+    """
+    Collect the links wanted by all tasks
+
+    Returns a mapping of link path to Link together with a list of conflicts.
+    Links to targets that don't exist are dropped before anything else, when
+    several apps want the same link the first one left wins.
+    """
+    links, conflicts = {}, {}
+    for candidate in candidates(tasks):
+        if not os.path.exists(candidate.target):
+            continue
+
+        link = links.get(candidate.path)
+        if link is None:
+            links[candidate.path] = candidate
+        elif link.target != candidate.target:
+            owners = conflicts.setdefault(candidate.path, [link.owner])
+            owners.append(candidate.owner)
+
+    return links, [Conflict(p, tuple(o)) for p, o in conflicts.items()]
+
+
+def scan(directories):
+    """
+    Scan each directory once and return the entries we might care about
+
+    Symlinks are mapped to where they point and any other file is mapped to
+    None as we are not allowed to touch those.
+    """
+    existing = {}
+    for directory in directories:
+        try:
+            entries = os.scandir(directory)
+        except FileNotFoundError:
+            continue
+
+        with entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    existing[entry.path] = os.readlink(entry.path)
+                else:
+                    existing[entry.path] = None
+    return existing
+
+
+def plan(links, existing):
+    """
+    Diff the desired links against the existing ones
+
+    Returns a list of (operation, Link) and a list of conflicts with files that
+    we don't own. Nothing is ever removed here, see `LinkFarm.prune`.
+    """
+    ops, conflicts = [], []
+    for path, link in links.items():
+        if path not in existing:
+            ops.append((CREATE, link))
+            continue
+
+        current = existing[path]
+        if current is None:
+            conflicts.append(Conflict(path, (link.owner, None)))
+        elif current != link.target:
+            ops.append((REPLACE, link))
+
+    return ops, conflicts
+
+
+def symlink(target, path):
+    """
+    Atomically point path to target
+    """
+    dirname, basename = os.path.split(path)
+    tmp = os.path.join(dirname, f'.{basename}.dotplug')
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+
+
+def apply(ops):
+    """
+    Apply the operations given from plan
+    """
+    for op, link in ops:
+        if op == REMOVE:
+            try:
+                os.remove(link.path)
+            except FileNotFoundError:
+                pass
+            continue
+
+        dirname = os.path.dirname(link.path)
+        if op == CREATE and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        symlink(link.target, link.path)
+
+
+class LinkFarm:
+    """
+    The links dotplug put in place for a scope
+
+    Tasks are linked one at a time as they finish, so whatever depends on them
+    can already find them, and links nobody wants anymore are pruned once
+    everything is done. The state is only written to disk if a path is given.
+    """
+
+    def __init__(self, path=None, scope=None):
+        self.path = path
+        self.scope = scope
+        self.managed = {}
+
+        # Links in place so far and the listing of each link directory, kept
+        # up to date as we go so every directory is only scanned once
+        self.links = {}
+        self.existing = {}
+        self._scanned = set()
+        self._lock = threading.Lock()
+
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.managed = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def save(self):
+        if self.path is None:
+            return
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.managed, f)
+        os.replace(tmp, self.path)
+
+    def link(self, task):
+        """
+        Create and replace the links wanted by task, nothing is removed
+
+        Only the links of task are diffed, tasks linked before it keep their
+        links on conflicts. Returns the applied operations and the conflicts
+        task is part of.
+        """
+        wanted, conflicts = desired([task])
+        with self._lock:
+            links = {}
+            for path, link in wanted.items():
+                other = self.links.get(path)
+                if other is None:
+                    links[path] = link
+                elif other.target != link.target:
+                    conflicts.append(Conflict(path, (other.owner, link.owner)))
+
+            directories = {os.path.dirname(p) for p in links} - self._scanned
+            self.existing.update(scan(directories))
+            self._scanned |= directories
+
+            ops, file_conflicts = plan(links, self.existing)
+            apply(ops)
+            for _, link in ops:
+                self.existing[link.path] = link.target
+
+            conflicted = {c.path for c in file_conflicts}
+            for path, link in links.items():
+                if path in conflicted:
+                    continue
+                self.links[path] = link
+                self.managed[path] = {
+                    'target': link.target,
+                    'scope': self.scope,
+                }
+        return ops, conflicts + file_conflicts
+
+    def retain(self, names):
+        """
+        Forget the links of all tasks but names so they can be linked again
+
+        The directory listings are dropped as well, they may have changed
+        since.
+        """
+        with self._lock:
+            self.links = {
+                path: link for path, link in self.links.items()
+                if link.owner in names
+            }
+            self.existing = {}
+            self._scanned = set()
+
+    def prune(self, tasks):
+        """
+        Remove the links of our scope that none of the tasks want anymore
+
+        Links that no longer point where we left them have been taken over
+        and are only forgotten. Returns the applied operations.
+        """
+        wanted = {link.path for link in candidates(tasks)}
+        ops = []
+        with self._lock:
+            for path, record in list(self.managed.items()):
+                if record['scope'] != self.scope or path in wanted:
+                    continue
+
+                try:
+                    current = os.readlink(path)
+                except OSError:
+                    current = None
+                if current == record['target']:
+                    ops.append((REMOVE, Link(path, current, None)))
+                del self.managed[path]
+
+            apply(ops)
+            for _, link in ops:
+                self.existing.pop(link.path, None)
+        return ops
@@ -9,14 +9,22 @@ import shutil
 import asyncio
 from importlib import resources
 
-from dotplug.tasks import mktask
+from dotplug import data, links, trace
+from dotplug.tasks import (
+    mktask,
+    ARCHIVE_DIRECTORY,
+    INSTALL_LOCATION,
+)
 # XXX: Utils
-from dotplug.archive import ensure_archive
-from dotplug.console import run, TaskBar, TaskStatus
+from dotplug.archive import ensure_archive, wait_for_repacks
+from dotplug.mirrors import MirrorStats
+from dotplug.console import run, TaskBar, HeadlessBar, TaskStatus
 
 MAX_QUEUE_SIZE = 6
 CONSOLE_MARGIN = 4
 
+MANIFEST = os.path.join(os.path.dirname(data.__file__), 'dotplug.json')
+
 
 # XXX:
 # Just in  general the write messages needs to be hanled better, it should be
@@ -41,43 +49,83 @@ async def ensure_dest(task):
 # modules, this module should be dedicated to the producer consumer pattern
 
 
-async def install(task):
+async def install(task, stats=None, session=None, index=None, farm=None):
     """
     Perform all steps necessary for app installation
+
+    stats, session and index are shared between tasks, see `ensure_archive`.
+    The task is linked into farm once installed, if given.
     """
 
-    with run(task.bar) as bar:
+    with run(task.bar) as bar, trace.span('install', app=task.name):
         if not task.not_dest:
-            state = await ensure_dest(task)
+            with trace.span('install.dest', app=task.name):
+                state = await ensure_dest(task)
         else:
             state = TaskStatus.NOT_INSTALLED
 
         if not state == TaskStatus.ALREADY_INSTALLED:
             if task.type is not None:
-                await ensure_archive(task)
-                task.message.clear()
+                with trace.span('install.archive', app=task.name):
+                    await ensure_archive(task, stats, session, index)
+                bar.message.clear()
 
             bar.message.write("Installing ...")
-            await asyncio.sleep(2)
-            result = await bar.loader.wait_for(task.install)
+            await bar.pause()
+            with trace.span('install.build', app=task.name):
+                result = await bar.loader.wait_for(task.install)
 
-            bar.message.write("Creating Symlinks ...")
-            await asyncio.sleep(2)
-            if task.link is not None:
-                result = await bar.loader.wait_for(task.make_links())
-
-            await task.update_current()
+            with trace.span('install.current', app=task.name):
+                await task.update_current()
             bar.message.clear()
             bar.message.write("Done")
         else:
             bar.message.write("Already Installed")
+
+        if farm is not None and task.link is not None:
+            with trace.span('install.links', app=task.name) as span:
+                ops, conflicts = await bar.loader.wait_for(farm.link, task)
+                span.set(changes=len(ops), conflicts=len(conflicts))
+            if conflicts:
+                names = ', '.join(os.path.basename(c.path) for c in conflicts)
+                bar.message.clear()
+                bar.message.write(f'Link Conflicts: {names}')
         bar.set_state(TaskStatus.SUCCESSFUL)
 
 
-async def producer(q):
+def mkbar(name, row, headless=False):
     """
-    Producer creates our worker tasks
+    Bar Factory
+    """
+    if headless:
+        return HeadlessBar(name)
+    return TaskBar(name, CONSOLE_MARGIN, row + CONSOLE_MARGIN)
+
+
+async def prune(farm, tasks, headless=False):
+    """
+    Remove the links none of the tasks want anymore
+    """
+    bar = mkbar('links', len(tasks), headless)
+    with run(bar), trace.span('links') as span:
+        bar.message.write('Pruning Symlinks ...')
+        ops = await bar.loader.wait_for(farm.prune, tasks)
+        farm.save()
+        span.set(changes=len(ops))
+
+        bar.message.clear()
+        bar.message.write(f'Done, {len(ops)} removed')
+        bar.set_state(TaskStatus.SUCCESSFUL)
+
+
+def manifest(path=None):
     """
+    Return the raw manifest entries, from path if given
+    """
+    if path is not None:
+        with open(path) as f:
+            return json.load(f)
+
     # XXX:
     # Hard coded for now, will be able to specify config setting in an rc file
     # located in the XDG_CONFIG_HOME directory
@@ -89,46 +137,89 @@ async def producer(q):
     #
     config = 'dotplug.json'
     with resources.open_text('dotplug.data', f'{config}') as f:
-        data = json.loads(f.read())
-        for idx, each in enumerate(data):
-            task = mktask(each)
-            # Each task get assigned a task that it'll own.
-            task.bar = TaskBar(task.name, CONSOLE_MARGIN, idx + CONSOLE_MARGIN)
-            await q.put(task)
+        return json.loads(f.read())
+
+
+async def producer(q, path=None, headless=False):
+    """
+    Producer creates our worker tasks
+
+    Returns all tasks created so the caller can act on the full set once the
+    consumers are done.
+    """
+    tasks = []
+    for idx, each in enumerate(manifest(path)):
+        task = mktask(each)
+        # Each task get assigned a task that it'll own.
+        task.bar = mkbar(task.name, idx, headless)
+        tasks.append(task)
+        await q.put(task)
+    return tasks
 
 
-async def consumer(q, seen):
+async def consumer(q, seen, stats, session=None, index=None, farm=None):
     """
     Consume tasks in the queue until the queue is empty
 
     If the task grabbed from the queue still has unfinised dependencies put
     the task at the back of the queue, rinse and repeat until evrything is
     done.
+
+    seen maps the name of each finished task to its final status, a failed
+    task fails everything depending on it. Tasks are linked into farm before
+    they are seen, so dependents can rely on their links.
     """
     while not q.empty():
         task = await q.get()
+        bar = task.bar
 
         # If task depends on other tasks we make sure that the task is only
         # operated on if all dependensies have been completed. Otherwise it
         # goes back into the products
-        if task.depend and not all(d in seen for d in task.depend):
+        if any(seen.get(d) == TaskStatus.FAILED for d in task.depend):
+            bar.message.write('Dependency Failed')
+            bar.set_state(TaskStatus.FAILED)
+            bar.done()
+            seen[task.name] = TaskStatus.FAILED
+        elif task.depend and not all(d in seen for d in task.depend):
             # Put a little delay here to not hit the CPU to hard
             await asyncio.sleep(0.5)
             await q.put(task)
         else:
-            await asyncio.create_task(install(task))
-            seen.add(task.name)
+            try:
+                await asyncio.create_task(
+                    install(task, stats, session, index, farm))
+            except Exception as e:
+                bar.message.clear()
+                bar.message.write(f'Failed: {e}')
+                bar.set_state(TaskStatus.FAILED)
+            seen[task.name] = bar.status.status
 
         q.task_done()
 
 
-async def main():
+async def main(path=None, headless=False):
     # Assign a queue with a set size
     q = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
 
-    seen = set()
-
-    p = producer(q)
-    c = [consumer(q, seen) for x in range(MAX_QUEUE_SIZE)]
-
-    return await asyncio.gather(p, *c)
+    seen = {}
+
+    # Mirror stats are shared by all downloads and kept between runs
+    stats = MirrorStats(os.path.join(ARCHIVE_DIRECTORY, '.mirrors.json'))
+    farm = links.LinkFarm(
+        os.path.join(INSTALL_LOCATION, links.STATE),
+        os.path.abspath(path or MANIFEST),
+    )
+
+    p = producer(q, path, headless)
+    c = [
+        consumer(q, seen, stats, farm=farm) for x in range(MAX_QUEUE_SIZE)
+    ]
+
+    try:
+        tasks, *_ = await asyncio.gather(p, *c)
+    finally:
+        stats.save()
+        farm.save()
+    await prune(farm, tasks, headless)
+    await wait_for_repacks()
@@ -0,0 +1,253 @@
+"""
+This module contains mirror selection for downloads
+
+When an archive is available from several mirrors the best ranked ones are
+raced, the first to deliver data is kept and the rest are dropped. If the
+chosen mirror stalls or fails mid-transfer we fail over to the remaining
+mirrors. Picking up where the last mirror left off with a range request
+splices the content of two hosts, so that is only done when the caller
+verifies the digest of the result.
+
+Latency and throughput of each mirror host is kept between runs so later
+downloads start with the mirrors that served us well.
+"""
+import os
+import json
+import time
+import hashlib
+import asyncio
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import aiohttp
+
+from dotplug import trace
+
+RACE_WIDTH = 3
+FIRST_CHUNK = 16 * 1024
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+STALL_TIMEOUT = 10
+FAILURE_PENALTY = 5.0
+
+# Weight of the latest sample in the moving averages
+ALPHA = 0.3
+
+Stream = namedtuple('Stream', ['url', 'response', 'first', 'offset'])
+
+
+class MirrorError(aiohttp.ClientError):
+    """
+    Raised when no mirror could deliver the requested content
+    """
+
+
+def host(url):
+    return urlparse(url).netloc
+
+
+class MirrorStats:
+    """
+    Moving averages of latency and throughput for each mirror host
+
+    Stats are only written to disk if a path is given.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hosts = {}
+
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.hosts = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def save(self):
+        if self.path is None:
+            return
+
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.hosts, f)
+        os.replace(tmp, self.path)
+
+    def _average(self, stats, key, value):
+        previous = stats.get(key)
+        if previous is None:
+            stats[key] = value
+        else:
+            stats[key] = ALPHA * value + (1 - ALPHA) * previous
+
+    def record(self, url, latency=None, throughput=None, failed=False):
+        stats = self.hosts.setdefault(host(url), {'failures': 0.0})
+        if failed:
+            stats['failures'] += 1
+            return
+
+        # Let old failures fade as the mirror behaves again
+        stats['failures'] /= 2
+        if latency is not None:
+            self._average(stats, 'latency', latency)
+        if throughput is not None:
+            self._average(stats, 'throughput', throughput)
+
+    def score(self, url):
+        """
+        Rough expected cost of using url, lower is better
+
+        Unknown mirrors cost nothing so they are given a chance in the race.
+        """
+        stats = self.hosts.get(host(url))
+        if stats is None:
+            return 0.0
+
+        cost = stats.get('latency', 0.0) + stats['failures'] * FAILURE_PENALTY
+        throughput = stats.get('throughput')
+        if throughput:
+            # Time to transfer a reference megabyte
+            cost += 1024 * 1024 / throughput
+        return cost
+
+    def rank(self, urls):
+        return sorted(urls, key=self.score)
+
+
+async def connect(session, url, stats, offset=0):
+    """
+    Request url from offset and wait for the first chunk of data
+
+    If the mirror ignores the range the returned stream starts from zero.
+    """
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    start = time.monotonic()
+
+    response = await session.get(url, headers=headers)
+    try:
+        response.raise_for_status()
+        first = await asyncio.wait_for(
+            response.content.read(FIRST_CHUNK), STALL_TIMEOUT)
+    except BaseException:
+        response.release()
+        raise
+
+    if offset and response.status != 206:
+        offset = 0
+
+    stats.record(url, latency=time.monotonic() - start)
+    return Stream(url, response, first, offset)
+
+
+async def race(session, urls, stats, offset=0):
+    """
+    Connect to the given mirrors at once and return the first to deliver
+
+    Returns the winning stream together with the mirrors that failed.
+    """
+    tasks = {
+        asyncio.ensure_future(connect(session, url, stats, offset)): url
+        for url in urls
+    }
+    winner = None
+    try:
+        for future in asyncio.as_completed(tasks):
+            try:
+                winner = await future
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+            break
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+    failed = []
+    for url, result in zip(tasks.values(), results):
+        if isinstance(result, Stream):
+            if result is not winner:
+                result.response.release()
+        elif not isinstance(result, asyncio.CancelledError):
+            stats.record(url, failed=True)
+            failed.append(url)
+    return winner, failed
+
+
+async def transfer(session, urls, f, stats, progress=None, resume=False):
+    """
+    Stream the content from the best of the given mirrors into f
+
+    f is an open `ArchiveWriter` and progress an optional callback receiving
+    the bytes written so far and the expected total. A failed over transfer
+    only resumes on the next mirror if resume is set, otherwise it starts over.
+    Returns the sha256 hexdigest of the content together with the etag of the
+    mirror that finished the transfer.
+    """
+    candidates = stats.rank(urls)
+    sha = hashlib.sha256()
+    total = 0
+
+    while candidates:
+        offset = total if resume else 0
+        with trace.span('mirrors.race', offset=offset) as span:
+            stream, failed = await race(
+                session, candidates[:RACE_WIDTH], stats, offset)
+            span.set(failed=len(failed))
+        for url in failed:
+            candidates.remove(url)
+        if stream is None:
+            continue
+
+        response = stream.response
+        if stream.offset != total:
+            # Not resuming or the mirror could not, start over
+            await f.reset()
+            sha = hashlib.sha256()
+            total = 0
+
+        size = total + int(response.headers.get('content-length', 0))
+        f.preallocate(size)
+        etag = response.headers.get('etag', '').strip('"')
+        start, received = time.monotonic(), 0
+        chunk_size = MIN_CHUNK
+        try:
+            with trace.span('mirrors.transfer', url=stream.url) as span:
+                try:
+                    chunk = stream.first
+                    while chunk:
+                        await f.write(chunk)
+                        sha.update(chunk)
+                        total += len(chunk)
+                        received += len(chunk)
+                        if progress is not None:
+                            progress(total, size)
+
+                        chunk = await asyncio.wait_for(
+                            response.content.read(chunk_size), STALL_TIMEOUT)
+
+                        # Grow reads while the network keeps them full, shrink
+                        # them again when it can't keep up
+                        if len(chunk) == chunk_size:
+                            chunk_size = min(chunk_size * 2, MAX_CHUNK)
+                        elif len(chunk) < chunk_size // 4:
+                            chunk_size = max(chunk_size // 2, MIN_CHUNK)
+                finally:
+                    span.set(bytes=received)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # Fail over, keeping what we got so far in case we can resume
+            stats.record(stream.url, failed=True)
+            candidates.remove(stream.url)
+            continue
+        finally:
+            response.release()
+
+        elapsed = max(time.monotonic() - start, 1e-6)
+        stats.record(stream.url, throughput=received / elapsed)
+        return sha.hexdigest(), etag
+
+    raise MirrorError('all mirrors failed')
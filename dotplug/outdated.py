@@ -0,0 +1,261 @@
+"""
+This module contains functionality for finding outdated manifest entries
+
+The latest version of each entry is resolved concurrently, either from the tag
+listing of github hosted repos or by probing the repo url template with bumped
+versions. All responses are kept in an on-disk cache so repeated runs within
+the ttl don't hit the network at all, and stale entries are revalidated with
+conditional requests.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+
+import aiohttp
+
+from dotplug.tasks import ARCHIVE_DIRECTORY
+
+GITHUB_API = os.environ.get('_BASE_GITHUB_API', 'https://api.github.com')
+METADATA_CACHE = os.path.join(ARCHIVE_DIRECTORY, '.metadata.json')
+
+DEFAULT_TTL = 6 * 60 * 60
+MAX_CONCURRENCY = 16
+MAX_PROBES = 20
+MAX_PAGES = 50
+
+_GITHUB = re.compile(
+    r'https?://github\.com/(?P<owner>[^/]+)/(?P<repo>[^/]+)/'
+    r'(?:archive/(?P<archive>.+?)\.(?:tar\.gz|tar\.bz2|tar\.xz|zip)'
+    r'|releases/download/(?P<release>[^/]+)/)'
+)
+
+
+def parse_version(version):
+    """
+    Return a comparable tuple from a dotted version string
+    """
+    return tuple(int(i) for i in version.split('.'))
+
+
+def bumps(version):
+    """
+    Return the next candidate versions, one for each version component
+    """
+    parts = parse_version(version)
+    candidates = []
+    for idx in range(len(parts)):
+        zeros = (0, ) * (len(parts) - idx - 1)
+        bumped = parts[:idx] + (parts[idx] + 1, ) + zeros
+        candidates.append('.'.join(str(i) for i in bumped))
+    return candidates
+
+
+class MetadataCache:
+    """
+    Disk backed cache of http responses
+
+    Entries are keyed on method and url and store the status, body and the
+    validators needed to make a conditional request once the entry has gone
+    stale.
+    """
+
+    def __init__(self, path=METADATA_CACHE, ttl=DEFAULT_TTL, concurrency=None):
+        self.path = path
+        self.ttl = ttl
+        self.semaphore = asyncio.Semaphore(concurrency or MAX_CONCURRENCY)
+
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    async def fetch(self, session, method, url, headers=None):
+        """
+        Return the cache entry for given request, using the cache if possible
+
+        Besides the status and body the entry holds the url of the next page
+        when the response is paginated. None is returned if the request
+        failed altogether.
+        """
+        key = f'{method} {url}'
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry['time'] < self.ttl:
+            return entry
+
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        async with self.semaphore:
+            try:
+                async with session.request(
+                        method, url, headers=headers,
+                        allow_redirects=True) as response:
+                    status = response.status
+                    if status == 304 and entry is not None:
+                        entry['time'] = time.time()
+                        return entry
+
+                    body = await response.text() if method == 'GET' else ''
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+                    next_url = response.links.get('next', {}).get('url')
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return None
+
+        fetched = {
+            'time': time.time(),
+            'status': status,
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'next': None if next_url is None else str(next_url),
+        }
+
+        # Rate limited and server errors are not worth remembering
+        if status not in (403, 429) and status < 500:
+            self.entries[key] = fetched
+        return fetched
+
+    async def request(self, session, method, url, headers=None):
+        """
+        Return (status, body) for given request, using the cache if possible
+        """
+        entry = await self.fetch(session, method, url, headers)
+        if entry is None:
+            return None, ''
+        return entry['status'], entry['body']
+
+
+async def github_latest(session, cache, match):
+    """
+    Resolve the latest version from the tag listing of a github repo
+
+    Tags are not listed in version order so every page is read.
+    """
+    template = match.group('archive') or match.group('release')
+    prefix, _, suffix = template.partition('{version}')
+    pattern = re.compile(
+        re.escape(prefix) + r'(\d+(?:\.\d+)*)' + re.escape(suffix) + '$')
+
+    headers = {'Accept': 'application/vnd.github+json'}
+    token = os.environ.get('GITHUB_TOKEN')
+    if token:
+        headers['Authorization'] = f'token {token}'
+
+    owner, repo = match.group('owner'), match.group('repo')
+    url = f'{GITHUB_API}/repos/{owner}/{repo}/tags?per_page=100'
+
+    versions = []
+    for _ in range(MAX_PAGES):
+        entry = await cache.fetch(session, 'GET', url, headers)
+        if entry is None or entry['status'] != 200:
+            # A partial listing could hide the latest version
+            return None
+
+        try:
+            names = [tag['name'] for tag in json.loads(entry['body'])]
+            found = [pattern.match(name) for name in names]
+        except (ValueError, KeyError, TypeError):
+            # Not a tag listing, an error page or a misconfigured api host
+            return None
+        versions.extend(f.group(1) for f in found if f is not None)
+
+        url = entry.get('next')
+        if url is None:
+            break
+    return max(versions, key=parse_version, default=None)
+
+
+async def probe_latest(session, cache, repo, entry):
+    """
+    Resolve the latest version by probing the repo url with bumped versions
+
+    Each round checks all candidates concurrently and continues from the
+    highest one that exists.
+    """
+    kind = entry.get('type')
+    latest = entry['version']
+
+    async def exists(version):
+        url = repo.format(version=version, type=kind)
+        status, _ = await cache.request(session, 'HEAD', url)
+        return status == 200
+
+    for _ in range(MAX_PROBES):
+        candidates = bumps(latest)
+        found = await asyncio.gather(*(exists(v) for v in candidates))
+        available = [v for v, ok in zip(candidates, found) if ok]
+        if not available:
+            break
+        latest = max(available, key=parse_version)
+    return latest
+
+
+async def latest(session, cache, entry):
+    """
+    Resolve the latest version of a manifest entry, None if unknown
+    """
+    repo = entry.get('repo')
+    if isinstance(repo, list):
+        # Mirrors all carry the same versions, the first one will do
+        repo = repo[0]
+    if repo is None or '{version}' not in repo:
+        return None
+
+    try:
+        parse_version(entry['version'])
+    except ValueError:
+        return None
+
+    match = _GITHUB.match(repo)
+    if match is not None and '{version}' in (
+            match.group('archive') or match.group('release')):
+        return await github_latest(session, cache, match)
+    return await probe_latest(session, cache, repo, entry)
+
+
+async def outdated(entries, ttl=DEFAULT_TTL, concurrency=MAX_CONCURRENCY):
+    """
+    Return (name, current, latest) for all entries with a newer version
+    """
+    cache = MetadataCache(ttl=ttl, concurrency=concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        results = await asyncio.gather(
+            *(latest(session, cache, e) for e in entries),
+            return_exceptions=True)
+    cache.save()
+
+    # A broken entry or response only leaves that entry unknown
+    results = [None if isinstance(r, Exception) else r for r in results]
+
+    return [(e['name'], e['version'], v) for e, v in zip(entries, results)
+            if v is not None
+            and parse_version(v) > parse_version(e['version'])]
+
+
+def report(rows):
+    """
+    Print the outdated entries as a table
+    """
+    rows = [('name', 'current', 'latest')] + list(rows)
+    widths = [max(len(r[i]) for r in rows) for i in range(3)]
+    for row in rows:
+        print('  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip())
@@ -0,0 +1,143 @@
+"""
+This module contains the archive cache server
+
+Exposes the local ARCHIVE_DIRECTORY over http so other machines on the same
+network can use it as a peer cache before hitting the upstream repo.
+
+Archives are served with the same layout as on disk:
+
+    /{name}/{name}-{version}.{type}
+
+The ETag of each archive is the sha256 digest of its content, it stays the
+same for as long as the content does no matter when the file was written.
+"""
+import os
+import hashlib
+import asyncio
+
+from aiohttp import web
+
+from dotplug.tasks import ARCHIVE_DIRECTORY
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 8765
+CHUNK_SIZE = 256 * 1024
+
+# Digests are expensive to compute on large archives, keep them around for as
+# long as the file stays the same.
+_DIGESTS = {}
+
+
+def file_digest(path):
+    """
+    Return the sha256 hexdigest of given path
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+async def cached_digest(path, stat):
+    """
+    Return the digest of path, only computed if the file changed on disk
+    """
+    key = (stat.st_mtime_ns, stat.st_size)
+    try:
+        cached_key, digest = _DIGESTS[path]
+    except KeyError:
+        pass
+    else:
+        if cached_key == key:
+            return digest
+
+    loop = asyncio.get_event_loop()
+    digest = await loop.run_in_executor(None, file_digest, path)
+    _DIGESTS[path] = (key, digest)
+    return digest
+
+
+def resolve(root, name, filename):
+    """
+    Resolve the archive path, making sure we never leave the root directory
+    """
+    if name.startswith('.') or filename.startswith('.'):
+        raise web.HTTPNotFound()
+
+    path = os.path.join(root, name, filename)
+    if not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    return path
+
+
+class ArchiveResponse(web.FileResponse):
+    """
+    File response using the digest of the archive as its etag
+
+    Range, If-Range and HEAD requests are left to `web.FileResponse`, which
+    only knows about etags made from the modification time.
+    """
+
+    def __init__(self, path, digest):
+        super().__init__(
+            path,
+            chunk_size=CHUNK_SIZE,
+            headers={'Content-Type': 'application/octet-stream'},
+        )
+        self.digest = digest
+
+    async def prepare(self, request):
+        # A range is only honored if the client still talks about the same
+        # file
+        if_range = request.headers.get('If-Range', '')
+        if if_range.startswith(('"', 'W/')) and if_range != f'"{self.digest}"':
+            headers = request.headers.copy()
+            headers.popall('Range', None)
+            headers.popall('If-Range')
+            request = request.clone(headers=headers)
+        return await super().prepare(request)
+
+
+async def set_etag(request, response):
+    """
+    Swap the etag of archive responses for the digest, right before the
+    headers are sent
+    """
+    if isinstance(response, ArchiveResponse) and response.status in (200, 206):
+        response.etag = response.digest
+
+
+async def archive(request):
+    """
+    Serve a single archive, supporting conditional and range requests
+    """
+    root = request.app['root']
+    path = resolve(
+        root,
+        request.match_info['name'],
+        request.match_info['filename'],
+    )
+    digest = await cached_digest(path, os.stat(path))
+
+    if digest in (e.value for e in request.if_none_match or ()):
+        raise web.HTTPNotModified(headers={'ETag': f'"{digest}"'})
+    return ArchiveResponse(path, digest)
+
+
+def make_app(root=ARCHIVE_DIRECTORY):
+    """
+    Create the archive cache application serving from root
+    """
+    app = web.Application()
+    app['root'] = root
+    app.on_response_prepare.append(set_etag)
+    app.router.add_get('/{name}/{filename}', archive)
+    return app
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, root=ARCHIVE_DIRECTORY):
+    """
+    Run the archive cache server until interrupted
+    """
+    web.run_app(make_app(root), host=host, port=port)
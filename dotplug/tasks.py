@@ -5,6 +5,7 @@ import os
 import shutil
 import asyncio
 
+from dotplug import trace
 from dotplug.archive import untar, unzip
 
 # XXX:
@@ -23,6 +24,7 @@ class BaseApp:
             build,
             type=None,
             repo=None,
+            sha256=None,
             link=None,
             depend=None,
             bar=None,
@@ -35,6 +37,7 @@ class BaseApp:
         self.type = type
         self.build = build
         self.repo = repo
+        self.sha256 = sha256
         self.force = force
         self.bar = bar
 
@@ -57,7 +60,15 @@ class BaseApp:
 
     @property
     def url(self):
-        return self.repo.format(version=self.version, type=self.type)
+        return self.urls[0]
+
+    @property
+    def urls(self):
+        """
+        All mirror urls of the app, repo is either a single template or a list
+        """
+        repos = [self.repo] if isinstance(self.repo, str) else self.repo
+        return [r.format(version=self.version, type=self.type) for r in repos]
 
     @property
     def archive(self):
@@ -75,7 +86,10 @@ class BaseApp:
             self.version,
         )
 
-    async def make_links(self):
+    def links(self):
+        """
+        Return the (link, target) pairs this app wants in place
+        """
         src = self.link.get('src')
         targets = self.link.get('targets')
         dest = self.link.get('dest', None)
@@ -93,20 +107,10 @@ class BaseApp:
         except KeyError:
             pass
 
-        for target in targets:
-            trgt = os.path.join(src, target)
-            src = os.path.join(dest, target)
-
-            if not os.path.exists(trgt):
-                continue
-
-            # Remove already existing links
-            try:
-                os.remove(src)
-            except FileNotFoundError:
-                pass
-
-            os.symlink(trgt, src)
+        return [
+            (os.path.join(dest, target), os.path.join(src, target))
+            for target in targets
+        ]
 
     async def update_current(self):
         dest = self.dest
@@ -128,6 +132,7 @@ class BaseApp:
 class AppImage(BaseApp):
     def install(self):
         app = os.path.join(self.dest, self.name)
+        os.makedirs(self.dest, exist_ok=True)
         shutil.copyfile(self.archive, app)
         os.chmod(app, 0o755)
 
@@ -162,16 +167,20 @@ class AppCommand(BaseApp):
                 # Really need a better way to handle messages
                 clear()
                 write(command)
-                await asyncio.sleep(2)
-
-                proc = await asyncio.create_subprocess_shell(
-                    command,
-                    stdout=asyncio.subprocess.DEVNULL,
-                    stderr=asyncio.subprocess.DEVNULL,
-                    env=env,
-                    cwd=cwd,
-                )
-                stdout, stderr = await proc.communicate()
+                await self.bar.pause()
+
+                with trace.span(
+                        'command.subprocess', app=self.name,
+                        cmd=command) as span:
+                    proc = await asyncio.create_subprocess_shell(
+                        command,
+                        stdout=asyncio.subprocess.DEVNULL,
+                        stderr=asyncio.subprocess.DEVNULL,
+                        env=env,
+                        cwd=cwd,
+                    )
+                    stdout, stderr = await proc.communicate()
+                    span.set(returncode=proc.returncode)
 
             # XXX:
             # If build fail we need to communicate that
@@ -0,0 +1,231 @@
+"""
+This module contains phase level tracing
+
+Spans are cheap to sprinkle around the code, when tracing is disabled `span`
+returns a shared no-op object so instrumented code pays for little more than
+a function call.
+
+    with trace.span('download', url=url) as s:
+        ...
+        s.set(bytes=total)
+
+Collected spans can be exported as chrome trace-event json, to be loaded in
+chrome://tracing or perfetto, or printed as a summary table.
+"""
+import json
+import time
+import asyncio
+import threading
+
+_tracer = None
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'attrs', 'track', 'start', 'end')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.track = None
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        self.track = self.tracer.track()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter_ns()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.spans.append(self)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer:
+    """
+    Collects finished spans and event loop lag samples
+    """
+
+    def __init__(self):
+        self.origin = time.perf_counter_ns()
+        self.spans = []
+        self.lag = []
+        self._tracks = {}
+
+    def span(self, name, attrs):
+        return Span(self, name, attrs)
+
+    def track(self):
+        """
+        Name of what is currently running, the asyncio task where there is
+        one and the thread otherwise
+        """
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        if task is not None:
+            key = task.get_name()
+        else:
+            key = threading.current_thread().name
+        return self._tracks.setdefault(key, len(self._tracks) + 1)
+
+    async def sample_lag(self, interval=0.05):
+        """
+        Record how late the event loop wakes us up, run until cancelled
+        """
+        while True:
+            start = time.perf_counter_ns()
+            await asyncio.sleep(interval)
+            late = time.perf_counter_ns() - start - int(interval * 1e9)
+            self.lag.append((start, max(late, 0)))
+
+
+def enable():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def tracer():
+    return _tracer
+
+
+def span(name, **attrs):
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, attrs)
+
+
+async def profile(coro, lag_interval=None):
+    """
+    Run coro under a root span, sampling event loop lag if an interval is
+    given
+    """
+    sampler = None
+    if lag_interval and _tracer is not None:
+        sampler = asyncio.ensure_future(_tracer.sample_lag(lag_interval))
+    try:
+        with span('run'):
+            return await coro
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+
+
+def chrome(tracer):
+    """
+    Return the collected spans as chrome trace-event json
+    """
+    def us(ns):
+        return (ns - tracer.origin) / 1000
+
+    events = [{
+        'name': 'thread_name',
+        'ph': 'M',
+        'pid': 1,
+        'tid': tid,
+        'args': {'name': name},
+    } for name, tid in tracer._tracks.items()]
+
+    for s in tracer.spans:
+        events.append({
+            'name': s.name,
+            'cat': s.name.split('.')[0],
+            'ph': 'X',
+            'ts': us(s.start),
+            'dur': s.duration / 1000,
+            'pid': 1,
+            'tid': s.track,
+            'args': s.attrs,
+        })
+
+    for start, late in tracer.lag:
+        events.append({
+            'name': 'loop lag',
+            'ph': 'C',
+            'ts': us(start),
+            'pid': 1,
+            'args': {'ms': late / 1e6},
+        })
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome(tracer, path):
+    with open(path, 'w') as f:
+        json.dump(chrome(tracer), f, default=str)
+
+
+def summary(tracer):
+    """
+    Return a plain table of time spent in each kind of span
+    """
+    phases = {}
+    for s in tracer.spans:
+        phase = phases.setdefault(s.name, [0, 0, 0, 0, 0])
+        phase[0] += 1
+        phase[1] += s.duration
+        phase[2] = max(phase[2], s.duration)
+        phase[3] += s.attrs.get('bytes', 0)
+        phase[4] += 'error' in s.attrs or s.attrs.get('returncode', 0) != 0
+
+    rows = [('phase', 'count', 'total ms', 'max ms', 'bytes', 'errors')]
+    for name, (count, total, longest, size, errors) in sorted(
+            phases.items(), key=lambda p: -p[1][1]):
+        rows.append((
+            name,
+            str(count),
+            f'{total / 1e6:.1f}',
+            f'{longest / 1e6:.1f}',
+            str(size),
+            str(errors),
+        ))
+
+    if tracer.lag:
+        lags = [late for _, late in tracer.lag]
+        rows.append((
+            'loop lag',
+            str(len(lags)),
+            f'{sum(lags) / 1e6:.1f}',
+            f'{max(lags) / 1e6:.1f}',
+            '',
+            '',
+        ))
+
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    return '\n'.join(
+        '  '.join(c.ljust(w) for c, w in zip(row, widths)).rstrip()
+        for row in rows)
@@ -13,7 +13,6 @@ setup(
     license='MIT',
     install_requires=[
         'aiohttp',
-        'aiofiles',
         'uvloop',
     ],
     entry_points={
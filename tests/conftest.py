@@ -0,0 +1,39 @@
+"""
+Shared test setup
+
+dotplug reads its locations from the environment on import, point them to a
+scratch directory before any test module imports it.
+"""
+import os
+import tempfile
+import contextlib
+
+import pytest
+from aiohttp import web
+
+_ROOT = tempfile.mkdtemp(prefix='dotplug-tests-')
+os.environ['_BASE_ARCHIVES'] = os.path.join(_ROOT, 'archives')
+os.environ['_BASE_OPT'] = os.path.join(_ROOT, 'opt')
+os.environ['XDG_BIN_HOME'] = os.path.join(_ROOT, 'bin')
+
+
+@contextlib.asynccontextmanager
+async def _serving(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        await runner.cleanup()
+
+
+@pytest.fixture
+def serving():
+    """
+    Async context manager running an aiohttp app on an ephemeral port,
+    yielding its base url
+    """
+    return _serving
@@ -0,0 +1,109 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from dotplug import archive
+
+MEMBERS = {
+    'bin/tool': (b'#!/bin/sh\necho tool\n', 0o755),
+    'share/doc/README': (b'readme\n' * 100, 0o644),
+    'share/data.bin': (bytes(range(256)) * 64, 0o600),
+    'empty': (b'', 0o644),
+}
+
+
+def make_tar(path):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, (data, mode) in MEMBERS.items():
+            info = tarfile.TarInfo(f'tool-1.0/{name}')
+            info.size = len(data)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+def make_zip(path):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, (data, _) in MEMBERS.items():
+            z.writestr(f'tool-1.0/{name}', data)
+    return str(path)
+
+
+def tree(root):
+    """
+    Return every file below root with its content and mode
+    """
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, 'rb') as f:
+                files[os.path.relpath(path, root)] = (
+                    f.read(), os.stat(path).st_mode & 0o7777)
+    return files
+
+
+@pytest.mark.parametrize('make, extract', [
+    (make_tar, archive.untar),
+    (make_zip, archive.unzip),
+])
+def test_packed_matches_direct_extraction(tmp_path, make, extract):
+    path = make(tmp_path / 'tool-1.0.archive')
+    extract(path, str(tmp_path / 'direct'))
+
+    archive.repack(path)
+    assert archive.load_packed(path) is not None
+    extract(path, str(tmp_path / 'packed'))
+
+    direct = tree(tmp_path / 'direct')
+    assert sorted(direct) == sorted(MEMBERS)
+    assert tree(tmp_path / 'packed') == direct
+
+
+def test_touched_archive_invalidates_index(tmp_path):
+    path = make_tar(tmp_path / 'tool-1.0.tar')
+    archive.repack(path)
+
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    assert archive.load_packed(path) is None
+
+
+def test_replaced_archive_invalidates_index(tmp_path):
+    path = make_tar(tmp_path / 'tool-1.0.tar')
+    archive.repack(path)
+
+    replacement = make_zip(tmp_path / 'replacement')
+    os.replace(replacement, path)
+
+    assert archive.load_packed(path) is None
+
+
+def test_truncated_packed_is_rejected(tmp_path):
+    path = make_tar(tmp_path / 'tool-1.0.tar')
+    archive.repack(path)
+
+    with open(f'{path}.packed', 'r+b') as f:
+        f.truncate(os.path.getsize(f'{path}.packed') // 2)
+
+    assert archive.load_packed(path) is None
+
+    # Extraction falls back on the archive itself
+    archive.untar(path, str(tmp_path / 'dest'))
+    assert tree(tmp_path / 'dest')['share/data.bin'][0] == (
+        MEMBERS['share/data.bin'][0])
+
+
+def test_repack_fails_on_corrupt_archive(tmp_path):
+    path = make_tar(tmp_path / 'tool-1.0.tar')
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) // 2)
+
+    with pytest.raises((EOFError, tarfile.ReadError)):
+        archive.repack(path)
+    assert archive.load_packed(path) is None
+    assert not os.path.exists(f'{path}.packed.tmp')
@@ -0,0 +1,153 @@
+import os
+import json
+import asyncio
+
+import pytest
+
+from dotplug import daemon, tasks
+from dotplug.tasks import DEFAULT_USER_BIN
+
+
+def run_daemon(tmp_path, paths, client):
+    """
+    Run a daemon on paths and call client with its socket path
+    """
+    socket_path = str(tmp_path / 'dotplug.sock')
+
+    async def run():
+        d = daemon.Daemon(paths, socket_path)
+        running = asyncio.ensure_future(d.run())
+        while not os.path.exists(socket_path):
+            await asyncio.sleep(0.01)
+
+        loop = asyncio.get_event_loop()
+        try:
+            return d, await loop.run_in_executor(None, client, socket_path)
+        finally:
+            d._stopped.set()
+            await running
+
+    return asyncio.run(run())
+
+
+def write_manifest(path, entries):
+    with open(path, 'w') as f:
+        json.dump(entries, f)
+
+
+def test_relative_manifest_after_chdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    write_manifest('m.json', [
+        {'name': 'app', 'version': '1.0', 'build': 'command', 'cmds': []},
+    ])
+
+    def client(socket_path):
+        # Builds chdir the whole process
+        os.chdir('/')
+        return daemon.request('apply', socket_path, force=True)
+
+    _, response = run_daemon(tmp_path, ['m.json'], client)
+
+    assert 'error' not in response
+    assert response['changed'] == ['app']
+
+
+def test_failed_apply_still_replies(tmp_path, monkeypatch):
+    manifest = str(tmp_path / 'm.json')
+    write_manifest(manifest, [])
+
+    async def apply(self, force=False):
+        raise OSError('disk full')
+
+    def client(socket_path):
+        monkeypatch.setattr(daemon.Daemon, 'apply', apply)
+        return daemon.request('apply', socket_path)
+
+    _, response = run_daemon(tmp_path, [manifest], client)
+
+    assert response == {'error': 'OSError: disk full'}
+
+
+def package(name, version='1.0', **kw):
+    return dict({
+        'name': name,
+        'version': version,
+        'build': 'command',
+        'cmds': [{'cmds': [
+            'mkdir -p {0.dest}/bin',
+            f'touch {{0.dest}}/bin/{name}',
+        ]}],
+        'link': {'src': '{.dest}/bin', 'targets': [name]},
+    }, **kw)
+
+
+@pytest.fixture
+def applying(tmp_path, monkeypatch):
+    """
+    Return a function applying the given manifests in order with a single
+    daemon, returning the response of each apply
+    """
+    opt, bin_dir = tmp_path / 'opt', tmp_path / 'bin'
+    monkeypatch.setattr(tasks, 'INSTALL_LOCATION', str(opt))
+    monkeypatch.setattr(daemon, 'INSTALL_LOCATION', str(opt))
+    monkeypatch.setenv(DEFAULT_USER_BIN, str(bin_dir))
+    bin_dir.mkdir()
+    manifest = str(tmp_path / 'm.json')
+
+    def applying(*manifests):
+        async def run():
+            d = daemon.Daemon([manifest], str(tmp_path / 'dotplug.sock'))
+            responses = []
+            for entries in manifests:
+                write_manifest(manifest, entries)
+                responses.append(await d.apply())
+            return responses
+        return asyncio.run(run())
+    return applying
+
+
+def test_unchanged_entries_are_skipped(applying):
+    first, second = applying(
+        [package('a'), package('b')],
+        [package('a'), package('b')],
+    )
+
+    assert sorted(first['changed']) == ['a', 'b']
+    assert second['changed'] == []
+    assert second['failed'] == []
+
+
+def test_version_bump_applies_only_that_entry(applying, tmp_path):
+    _, bumped = applying(
+        [package('a'), package('b')],
+        [package('a'), package('b', version='2.0')],
+    )
+
+    assert bumped['changed'] == ['b']
+    assert os.readlink(tmp_path / 'bin' / 'b') == str(
+        tmp_path / 'opt' / 'b' / '2.0' / 'bin' / 'b')
+
+
+def test_removed_entry_is_pruned(applying, tmp_path):
+    _, removed = applying(
+        [package('a'), package('b')],
+        [package('a')],
+    )
+
+    assert removed['removed'] == ['b']
+    assert removed['pruned'] == 1
+    assert os.listdir(tmp_path / 'bin') == ['a']
+
+
+def test_failed_entry_is_retried(applying, tmp_path):
+    waiting = package('b', depend=['a'])
+    failed, retried = applying(
+        [waiting, {'name': 'bad', 'build': 'command'}],
+        [package('a'), waiting],
+    )
+
+    # Missing dependencies are no packages of their own
+    assert failed['failed'] == ['b', 'bad']
+    assert sorted(retried['changed']) == ['a', 'b']
+    assert retried['failed'] == []
+    assert sorted(os.listdir(tmp_path / 'bin')) == ['a', 'b']
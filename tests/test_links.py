@@ -0,0 +1,158 @@
+import os
+
+import pytest
+
+from dotplug import links
+from dotplug.tasks import mktask
+
+
+@pytest.fixture
+def bin_dir(tmp_path):
+    path = tmp_path / 'bin'
+    path.mkdir()
+    return path
+
+
+def app(tmp_path, bin_dir, name, targets, installed=True):
+    src = tmp_path / 'opt' / name
+    if installed:
+        src.mkdir(parents=True)
+        for target in targets:
+            (src / target).write_text('')
+
+    return mktask({
+        'name': name,
+        'version': '1.0',
+        'build': 'command',
+        'link': {'src': str(src), 'dest': str(bin_dir), 'targets': targets},
+    })
+
+
+def test_desired_skips_missing_targets(tmp_path, bin_dir):
+    zsh = app(tmp_path, bin_dir, 'zsh', ['zsh', 'nvim'], installed=False)
+    nvim = app(tmp_path, bin_dir, 'nvim', ['nvim'])
+
+    wanted, conflicts = links.desired([zsh, nvim])
+
+    assert list(wanted) == [str(bin_dir / 'nvim')]
+    assert wanted[str(bin_dir / 'nvim')].owner == 'nvim'
+    assert conflicts == []
+
+
+def test_desired_first_owner_wins(tmp_path, bin_dir):
+    vim = app(tmp_path, bin_dir, 'vim', ['vi'])
+    nvim = app(tmp_path, bin_dir, 'nvim', ['vi'])
+
+    wanted, conflicts = links.desired([vim, nvim])
+
+    assert wanted[str(bin_dir / 'vi')].owner == 'vim'
+    assert conflicts == [links.Conflict(str(bin_dir / 'vi'), ('vim', 'nvim'))]
+
+
+def test_plan(tmp_path, bin_dir):
+    task = app(tmp_path, bin_dir, 'tools', ['a', 'b', 'c', 'd'])
+    os.symlink(str(tmp_path / 'opt' / 'tools' / 'a'), bin_dir / 'a')
+    os.symlink('/elsewhere', bin_dir / 'b')
+    (bin_dir / 'c').write_text('not ours')
+
+    wanted, _ = links.desired([task])
+    ops, conflicts = links.plan(wanted, links.scan([str(bin_dir)]))
+
+    assert [(op, link.path) for op, link in ops] == [
+        (links.REPLACE, str(bin_dir / 'b')),
+        (links.CREATE, str(bin_dir / 'd')),
+    ]
+    assert conflicts == [links.Conflict(str(bin_dir / 'c'), ('tools', None))]
+
+
+def test_link_links_each_task(tmp_path, bin_dir):
+    farm = links.LinkFarm(scope='a')
+    go = app(tmp_path, bin_dir, 'go', ['go'])
+
+    ops, conflicts = farm.link(go)
+
+    assert [op for op, _ in ops] == [links.CREATE]
+    assert conflicts == []
+    assert os.readlink(bin_dir / 'go') == str(tmp_path / 'opt' / 'go' / 'go')
+
+
+def test_prune_only_managed_links_of_scope(tmp_path, bin_dir):
+    state = str(tmp_path / 'links.json')
+    go = app(tmp_path, bin_dir, 'go', ['go'])
+    fd = app(tmp_path, bin_dir, 'fd', ['fd'])
+    rg = app(tmp_path, bin_dir, 'rg', ['rg'])
+
+    first = links.LinkFarm(state, 'first')
+    first.link(go)
+    first.link(fd)
+    first.save()
+
+    other = links.LinkFarm(state, 'other')
+    other.link(rg)
+    other.save()
+
+    # Made by hand, pointing into the same place
+    os.symlink(str(tmp_path / 'opt' / 'go' / 'go'), bin_dir / 'mine')
+
+    first = links.LinkFarm(state, 'first')
+    ops = first.prune([go])
+
+    assert [link.path for _, link in ops] == [str(bin_dir / 'fd')]
+    assert sorted(os.listdir(bin_dir)) == ['go', 'mine', 'rg']
+
+
+def test_prune_leaves_taken_over_links(tmp_path, bin_dir):
+    go = app(tmp_path, bin_dir, 'go', ['go'])
+    farm = links.LinkFarm(scope='a')
+    farm.link(go)
+
+    os.remove(bin_dir / 'go')
+    os.symlink('/usr/bin/go', bin_dir / 'go')
+
+    assert farm.prune([]) == []
+    assert os.readlink(bin_dir / 'go') == '/usr/bin/go'
+    assert farm.managed == {}
+
+
+def test_link_scans_each_directory_once(tmp_path, bin_dir, monkeypatch):
+    scanned = []
+    scan = links.scan
+
+    def counting(directories):
+        scanned.extend(directories)
+        return scan(directories)
+
+    monkeypatch.setattr(links, 'scan', counting)
+    farm = links.LinkFarm(scope='a')
+    for idx in range(10):
+        farm.link(app(tmp_path, bin_dir, f'app{idx}', [f'app{idx}']))
+
+    assert scanned == [str(bin_dir)]
+    assert len(os.listdir(bin_dir)) == 10
+
+
+def test_link_first_linked_wins(tmp_path, bin_dir):
+    farm = links.LinkFarm(scope='a')
+    vim = app(tmp_path, bin_dir, 'vim', ['vi'])
+    nvim = app(tmp_path, bin_dir, 'nvim', ['vi'])
+
+    farm.link(vim)
+    ops, conflicts = farm.link(nvim)
+
+    assert ops == []
+    assert conflicts == [links.Conflict(str(bin_dir / 'vi'), ('vim', 'nvim'))]
+    assert os.readlink(bin_dir / 'vi') == str(tmp_path / 'opt' / 'vim' / 'vi')
+
+
+def test_retain_lets_forgotten_links_move(tmp_path, bin_dir):
+    farm = links.LinkFarm(scope='a')
+    vim = app(tmp_path, bin_dir, 'vim', ['vi'])
+    nvim = app(tmp_path, bin_dir, 'nvim', ['vi'])
+    farm.link(vim)
+
+    farm.retain({'nvim'})
+    ops, conflicts = farm.link(nvim)
+
+    assert [op for op, _ in ops] == [links.REPLACE]
+    assert conflicts == []
+    assert os.readlink(bin_dir / 'vi') == str(tmp_path / 'opt' / 'nvim' / 'vi')
@@ -0,0 +1,61 @@
+import asyncio
+import hashlib
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from dotplug.archive import ArchiveWriter
+from dotplug.mirrors import MirrorStats, transfer
+
+CONTENT = bytes(range(256)) * 1024
+
+
+def mirror(ranges, broken=False, delay=0):
+    """
+    Serve CONTENT, cutting the connection halfway through if broken
+    """
+    async def handler(request):
+        ranges.append(request.headers.get('Range'))
+        await asyncio.sleep(delay)
+        if broken:
+            response = web.StreamResponse(
+                headers={'Content-Length': str(len(CONTENT))})
+            await response.prepare(request)
+            await response.write(CONTENT[:len(CONTENT) // 2])
+            request.transport.close()
+            return response
+
+        rng = request.http_range
+        start = rng.start or 0
+        status = 206 if start else 200
+        return web.Response(status=status, body=CONTENT[start:])
+
+    app = web.Application()
+    app.router.add_get('/archive', handler)
+    return app
+
+
+@pytest.mark.parametrize('resume', [False, True])
+def test_failover(serving, tmp_path, resume):
+    broken, fallback = [], []
+
+    async def run():
+        async with serving(mirror(broken, broken=True)) as first, \
+                serving(mirror(fallback, delay=0.2)) as second, \
+                aiohttp.ClientSession() as session:
+            path = tmp_path / 'archive'
+            async with ArchiveWriter(str(path)) as f:
+                digest, _ = await transfer(
+                    session, [f'{first}/archive', f'{second}/archive'], f,
+                    MirrorStats(), resume=resume)
+            return digest, path.read_bytes()
+
+    digest, content = asyncio.run(run())
+
+    assert content == CONTENT
+    assert digest == hashlib.sha256(CONTENT).hexdigest()
+    if resume:
+        assert fallback[-1].startswith('bytes=')
+    else:
+        assert fallback[-1] is None
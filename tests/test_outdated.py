@@ -0,0 +1,166 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from dotplug import outdated
+
+RELEASES = {'1.0', '1.1', '2.0', '2.1'}
+TAGS = [
+    [{'name': 'v1.9'}, {'name': 'v1.10'}, {'name': 'nightly'}],
+    [{'name': 'v1.2'}, {'name': 'v2.0.1'}],
+]
+ETAG = '"tags"'
+
+
+def mirror(hits):
+    """
+    Stand-in for both a plain download site and the github api
+    """
+    async def release(request):
+        hits.append(request.path)
+        version = request.match_info['version']
+        if version not in RELEASES:
+            raise web.HTTPNotFound()
+        return web.Response()
+
+    async def tags(request):
+        hits.append(request.path_qs)
+        if request.headers.get('If-None-Match') == ETAG:
+            raise web.HTTPNotModified()
+
+        page = int(request.query.get('page', 1))
+        headers = {'ETag': ETAG}
+        if page < len(TAGS):
+            url = request.url.update_query(page=page + 1)
+            headers['Link'] = f'<{url}>; rel="next"'
+        return web.json_response(TAGS[page - 1], headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/tool-{version}.tar', release)
+    app.router.add_get('/repos/owner/repo/tags', tags)
+    return app
+
+
+def resolve(serving, tmp_path, monkeypatch, entry, ttl, rounds=1):
+    """
+    Resolve entry rounds times against the stand-in with a shared cache,
+    returning the results and the requests made in each round
+    """
+    async def run():
+        async with serving(mirror(hits)) as url:
+            monkeypatch.setattr(outdated, 'GITHUB_API', url)
+            cache = outdated.MetadataCache(str(tmp_path / 'meta.json'), ttl)
+            results = []
+            async with aiohttp.ClientSession() as session:
+                for _ in range(rounds):
+                    hits.clear()
+                    entry['repo'] = entry['repo'].replace('{url}', url)
+                    version = await outdated.latest(session, cache, entry)
+                    results.append((version, list(hits)))
+            return results
+
+    hits = []
+    return asyncio.run(run())
+
+
+def probe_entry():
+    return {
+        'name': 'tool',
+        'version': '1.0',
+        'type': 'tar',
+        'repo': '{url}/tool-{version}.{type}',
+    }
+
+
+def github_entry():
+    return {
+        'name': 'repo',
+        'version': '1.2',
+        'type': 'tar.gz',
+        'repo': 'https://github.com/owner/repo/archive/v{version}.tar.gz',
+    }
+
+
+def test_bumps():
+    assert outdated.bumps('1.2.3') == ['2.0.0', '1.3.0', '1.2.4']
+
+
+def test_probe(serving, tmp_path, monkeypatch):
+    [(version, _)] = resolve(
+        serving, tmp_path, monkeypatch, probe_entry(), ttl=60)
+    assert version == '2.1'
+
+
+def test_github_tags_follow_pages(serving, tmp_path, monkeypatch):
+    [(version, hits)] = resolve(
+        serving, tmp_path, monkeypatch, github_entry(), ttl=60)
+
+    assert version == '2.0.1'
+    assert hits == [
+        '/repos/owner/repo/tags?per_page=100',
+        '/repos/owner/repo/tags?per_page=100&page=2',
+    ]
+
+
+@pytest.mark.parametrize('entry', [probe_entry, github_entry])
+def test_cache_hit_within_ttl(serving, tmp_path, monkeypatch, entry):
+    (first, _), (second, hits) = resolve(
+        serving, tmp_path, monkeypatch, entry(), ttl=60, rounds=2)
+
+    assert first == second
+    assert hits == []
+
+
+def test_revalidate_not_modified(serving, tmp_path, monkeypatch):
+    (first, _), (second, hits) = resolve(
+        serving, tmp_path, monkeypatch, github_entry(), ttl=0, rounds=2)
+
+    assert first == second == '2.0.1'
+    # Both pages are revalidated and the cached bodies reused
+    assert len(hits) == 2
+
+
+def test_outdated_only_lists_newer(serving):
+    async def run():
+        async with serving(mirror([])) as url:
+            current = dict(probe_entry(), version='2.1')
+            current['repo'] = current['repo'].replace('{url}', url)
+            older = dict(current, name='older', version='1.1')
+            return await outdated.outdated([current, older], ttl=0)
+
+    assert asyncio.run(run()) == [('older', '1.1', '2.1')]
+
+
+@pytest.mark.parametrize('body', [
+    '<html>rate limited</html>',
+    '{"message": "Not Found"}',
+    '[{"title": "v2.0"}]',
+])
+def test_github_unexpected_body(serving, tmp_path, monkeypatch, body):
+    async def tags(request):
+        return web.Response(text=body)
+
+    app = web.Application()
+    app.router.add_get('/repos/owner/repo/tags', tags)
+
+    async def run():
+        async with serving(app) as url:
+            monkeypatch.setattr(outdated, 'GITHUB_API', url)
+            cache = outdated.MetadataCache(str(tmp_path / 'meta.json'), 0)
+            async with aiohttp.ClientSession() as session:
+                return await outdated.latest(session, cache, github_entry())
+
+    assert asyncio.run(run()) is None
+
+
+def test_outdated_survives_broken_entry(serving):
+    async def run():
+        async with serving(mirror([])) as url:
+            older = dict(probe_entry(), version='1.1')
+            older['repo'] = older['repo'].replace('{url}', url)
+            broken = dict(older, name='broken', repo=42)
+            return await outdated.outdated([broken, older], ttl=0)
+
+    assert asyncio.run(run()) == [('tool', '1.1', '2.1')]
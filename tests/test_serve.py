@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from dotplug import archive, serve, tasks
+from dotplug.console import HeadlessBar
+
+GOOD = b'good archive content' * 1000
+BAD = b'stale archive content' * 1000
+
+
+def upstream(hits):
+    async def handler(request):
+        hits.append(request.path)
+        return web.Response(body=GOOD)
+
+    app = web.Application()
+    app.router.add_get('/{filename}', handler)
+    return app
+
+
+def peer_root(tmp_path, content):
+    root = tmp_path / 'peer'
+    (root / 'app').mkdir(parents=True)
+    (root / 'app' / 'app-1.0.tar').write_bytes(content)
+    return str(root)
+
+
+@pytest.fixture
+def mktask(tmp_path, monkeypatch):
+    monkeypatch.setattr(tasks, 'ARCHIVE_DIRECTORY', str(tmp_path / 'local'))
+
+    def mktask(url, sha256=None):
+        task = tasks.mktask({
+            'name': 'app',
+            'version': '1.0',
+            'build': 'binary',
+            'type': 'tar',
+            'repo': f'{url}/app-{{version}}.{{type}}',
+            'sha256': sha256,
+        })
+        task.bar = HeadlessBar(task.name)
+        return task
+    return mktask
+
+
+def install(serving, monkeypatch, task_factory, peer, sha256, hits):
+    async def run():
+        async with serving(serve.make_app(peer)) as peer_url, \
+                serving(upstream(hits)) as upstream_url:
+            monkeypatch.setattr(archive, 'ARCHIVE_PEERS', [peer_url])
+            task = task_factory(upstream_url, sha256)
+            async with aiohttp.ClientSession() as session:
+                await archive.download(session, task)
+            with open(task.archive, 'rb') as f:
+                return f.read()
+    return asyncio.run(run())
+
+
+def test_peer_hit(tmp_path, serving, monkeypatch, mktask):
+    hits = []
+    content = install(
+        serving, monkeypatch, mktask, peer_root(tmp_path, GOOD),
+        hashlib.sha256(GOOD).hexdigest(), hits)
+
+    assert content == GOOD
+    assert hits == []
+
+
+def test_peer_mismatch_falls_back_upstream(
+        tmp_path, serving, monkeypatch, mktask):
+    hits = []
+    content = install(
+        serving, monkeypatch, mktask, peer_root(tmp_path, BAD),
+        hashlib.sha256(GOOD).hexdigest(), hits)
+
+    assert content == GOOD
+    assert hits == ['/app-1.0.tar']
+
+
+def test_peer_skipped_without_digest(tmp_path, serving, monkeypatch, mktask):
+    hits = []
+    content = install(
+        serving, monkeypatch, mktask, peer_root(tmp_path, BAD), None, hits)
+
+    assert content == GOOD
+    assert hits == ['/app-1.0.tar']
+
+
+def get(serving, root, headers):
+    async def run():
+        async with serving(serve.make_app(root)) as url, \
+                aiohttp.ClientSession() as session, \
+                session.get(f'{url}/app/app-1.0.tar',
+                            headers=headers) as response:
+            return response.status, response.headers, await response.read()
+    return asyncio.run(run())
+
+
+def test_serve_full(tmp_path, serving):
+    status, headers, body = get(serving, peer_root(tmp_path, GOOD), {})
+
+    assert status == 200
+    assert body == GOOD
+    assert headers['ETag'] == f'"{hashlib.sha256(GOOD).hexdigest()}"'
+
+
+def test_serve_range(tmp_path, serving):
+    status, headers, body = get(
+        serving, peer_root(tmp_path, GOOD), {'Range': 'bytes=5-9'})
+
+    assert status == 206
+    assert body == GOOD[5:10]
+    assert headers['Content-Range'] == f'bytes 5-9/{len(GOOD)}'
+
+
+def test_serve_range_mismatched_if_range(tmp_path, serving):
+    status, _, body = get(
+        serving, peer_root(tmp_path, GOOD),
+        {'Range': 'bytes=5-9', 'If-Range': '"other"'})
+
+    assert status == 200
+    assert body == GOOD
+
+
+@pytest.mark.parametrize('value', ['garbage', 'bytes=0-1,5-6'])
+def test_serve_bad_range(tmp_path, serving, value):
+    status, _, _ = get(serving, peer_root(tmp_path, GOOD), {'Range': value})
+
+    assert status in (200, 416)
+
+
+def test_serve_not_modified(tmp_path, serving):
+    etag = f'"{hashlib.sha256(GOOD).hexdigest()}"'
+    status, headers, body = get(
+        serving, peer_root(tmp_path, GOOD), {'If-None-Match': etag})
+
+    assert status == 304
+    assert headers['ETag'] == etag
+    assert body == b''
+
+
+def test_serve_hidden(tmp_path, serving):
+    root = peer_root(tmp_path, GOOD)
+    (tmp_path / 'peer' / '.mirrors.json').write_text('{}')
+
+    async def run():
+        async with serving(serve.make_app(root)) as url, \
+                aiohttp.ClientSession() as session, \
+                session.get(f'{url}/app/.mirrors.json') as response:
+            return response.status
+    assert asyncio.run(run()) == 404
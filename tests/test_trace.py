@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from dotplug import trace
+
+
+@pytest.fixture
+def tracer():
+    tracer = trace.enable()
+    yield tracer
+    trace.disable()
+
+
+def test_disabled_span_is_shared():
+    trace.disable()
+    with trace.span('a', x=1) as span:
+        span.set(bytes=10)
+
+    assert span is trace._NULL_SPAN
+    assert trace.span('b') is span
+
+
+def test_span_records_errors(tracer):
+    with pytest.raises(ValueError):
+        with trace.span('failing'):
+            raise ValueError()
+
+    [span] = tracer.spans
+    assert span.attrs == {'error': 'ValueError'}
+
+
+def test_chrome(tracer):
+    async def run():
+        with trace.span('download', url='u') as span:
+            span.set(bytes=10)
+
+    asyncio.run(run())
+    with trace.span('extract'):
+        pass
+    tracer.lag.append((tracer.origin + 2000, 3_000_000))
+
+    events = trace.chrome(tracer)['traceEvents']
+    names = [e for e in events if e['ph'] == 'M']
+    spans = {e['name']: e for e in events if e['ph'] == 'X'}
+    [lag] = [e for e in events if e['ph'] == 'C']
+
+    assert {e['name'] for e in names} == {'thread_name'}
+    assert len(names) == 2
+    assert {e['tid'] for e in names} == {
+        spans['download']['tid'], spans['extract']['tid']}
+    assert spans['download']['tid'] != spans['extract']['tid']
+
+    download = spans['download']
+    assert download['args'] == {'url': 'u', 'bytes': 10}
+    assert download['ts'] >= 0
+    assert download['dur'] >= 0
+    assert spans['extract']['ts'] >= download['ts'] + download['dur']
+
+    assert lag['ts'] == 2
+    assert lag['args'] == {'ms': 3.0}
+
+
+def test_summary(tracer):
+    for size in (10, 20):
+        with trace.span('download') as span:
+            span.set(bytes=size)
+    for returncode in (0, 1, 2):
+        with trace.span('command.subprocess') as span:
+            span.set(returncode=returncode)
+
+    rows = [line.split() for line in trace.summary(tracer).splitlines()]
+    table = {row[0]: row[1:] for row in rows[1:]}
+
+    count, _, _, size, errors = table['download']
+    assert (count, size, errors) == ('2', '30', '0')
+    count, _, _, size, errors = table['command.subprocess']
+    assert (count, size, errors) == ('3', '0', '2')